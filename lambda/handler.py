@@ -1,7 +1,16 @@
 # handler.py
-import json, os, hashlib, urllib.request, urllib.error
+import gzip, hashlib, heapq, itertools, json, os, random, threading, time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
-import boto3
+import urllib3  # ships with botocore in the Lambda Python runtime
+try:
+    import ijson  # optional: stream the feed instead of parsing the whole document
+except ImportError:
+    ijson = None
+try:
+    import orjson  # optional: faster JSON encode/decode
+except ImportError:
+    orjson = None
 
 # =======================
 # Environment variables (set these in Lambda → Configuration → Environment variables)
@@ -13,6 +22,10 @@ HF_TOKEN = os.environ.get("HF_TOKEN", "")                      # optional
 MODEL = os.environ.get("MODEL", "qwen/qwen-2.5-7b-instruct")   # for OpenRouter
 MAX_ITEMS = int(os.environ.get("MAX_ITEMS", "40"))             # how many quakes to process per run
 SUMMARIES_TO_KEEP = int(os.environ.get("SUMMARIES_TO_KEEP", "50"))  # keep on website
+MIN_MAG = float(os.environ["MIN_MAG"]) if os.environ.get("MIN_MAG") else None  # skip quakes below this (unset = no limit)
+MAX_AGE_HOURS = float(os.environ.get("MAX_AGE_HOURS", "0"))    # skip older quakes (0 = no limit)
+SUMMARY_CONCURRENCY = int(os.environ.get("SUMMARY_CONCURRENCY", "12"))  # parallel AI calls
+SUMMARY_BATCH = int(os.environ.get("SUMMARY_BATCH", "10"))     # quakes per OpenRouter prompt
 
 # =======================
 # Data source: last ~30 days, magnitude >= 2.5 (worldwide)
@@ -20,23 +33,140 @@ SUMMARIES_TO_KEEP = int(os.environ.get("SUMMARIES_TO_KEEP", "50"))  # keep on we
 # =======================
 USGS_URL = "https://earthquake.usgs.gov/earthquakes/feed/v1.0/summary/2.5_month.geojson"
 
-# AWS clients
-dynamodb = boto3.client("dynamodb")
-s3 = boto3.client("s3")
+# OpenRouter chat completions (used by both the per-quake and the batched summaries)
+OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
+OPENROUTER_HEADERS = {
+    "Content-Type": "application/json",
+    "Authorization": f"Bearer {OPENROUTER_API_KEY}",
+    "HTTP-Referer": "https://example.com",
+    "X-Title": "Disaster Summarizer"
+}
+
+# AWS clients (boto3 is imported on first use to keep it out of the cold-start init)
+_clients = {}
+_clients_lock = threading.Lock()
+
+def _client(name: str):
+    """Create (once) and return a boto3 client."""
+    with _clients_lock:
+        if name not in _clients:
+            import boto3
+            _clients[name] = boto3.client(name)
+        return _clients[name]
+
+def _ddb():
+    """DynamoDB client."""
+    return _client("dynamodb")
+
+def _s3():
+    """S3 client."""
+    return _client("s3")
+
+# Keep-alive HTTP pool shared by all outbound calls (reuses TLS sessions across warm invocations)
+http = urllib3.PoolManager(num_pools=4, maxsize=SUMMARY_CONCURRENCY)
+
+# Fail fast on a stalled connect; reads get a per-call budget
+CONNECT_TIMEOUT = 3
+# USGS GET: one retry with backoff on connect errors and transient 5xx/429
+_USGS_RETRY = urllib3.Retry(total=1, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504))
+# AI POSTs: reconnect once (urllib3 never re-sends a POST after a read error)
+_AI_RETRY = urllib3.Retry(total=1)
+
+# Worker pool for the (I/O-bound) AI calls; created at import so it survives warm invocations
+_EXECUTOR = ThreadPoolExecutor(max_workers=SUMMARY_CONCURRENCY)
 
 def _id(s: str) -> str:
     """Short stable id from a string."""
-    return hashlib.sha1(s.encode("utf-8")).hexdigest()[:16]
+    return hashlib.blake2b(s.encode("utf-8"), digest_size=8).hexdigest()
+
+def _fmt_iso(ms: int) -> str:
+    """UTC ISO-8601 string for epoch milliseconds, same output as datetime.isoformat()."""
+    secs, msec = divmod(int(ms), 1000)  # integer split: no float rounding of the millis
+    base = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(secs))
+    return f"{base}.{msec:03d}000+00:00" if msec else base + "+00:00"
 
-def _fetch_usgs() -> dict:
-    """Download the USGS GeoJSON feed."""
-    req = urllib.request.Request(USGS_URL, headers={"User-Agent": "Mozilla/5.0"})
-    with urllib.request.urlopen(req, timeout=30) as r:
-        return json.loads(r.read().decode("utf-8"))
+def _dumpb(obj) -> bytes:
+    """Compact JSON as UTF-8 bytes (no spaces after separators, non-ASCII kept as-is)."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def _dumps(obj) -> str:
+    """Compact JSON as text."""
+    if orjson is not None:
+        return orjson.dumps(obj).decode("utf-8")
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+def _loads(data):
+    """Parse JSON from str or bytes."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def _send(method: str, url: str, headers: dict, body=None, read_timeout: float = 30,
+          retries=_AI_RETRY, stream: bool = False):
+    """Send a request through the shared pool; raises on HTTP errors.
+
+    With `stream=True` the body is left unread for the caller to consume (and close).
+    """
+    resp = http.request(
+        method, url,
+        body=_dumpb(body) if body is not None else None,
+        headers=headers,
+        timeout=urllib3.Timeout(connect=CONNECT_TIMEOUT, read=read_timeout),
+        retries=retries,
+        preload_content=not stream
+    )
+    if resp.status >= 400:
+        resp.close()
+        raise RuntimeError(f"HTTP {resp.status} from {url}")
+    return resp
+
+def _request_json(method: str, url: str, headers: dict, body=None, read_timeout: float = 30, retries=_AI_RETRY):
+    """Send a request through the shared pool and decode the JSON response."""
+    return _loads(_send(method, url, headers, body, read_timeout, retries).data)
+
+def _wanted(f: dict, now_ms: int) -> bool:
+    """MIN_MAG / MAX_AGE_HOURS filter, applied before anything is summarized."""
+    props = f.get("properties", {}) or {}
+    if MIN_MAG is not None:
+        mag = props.get("mag")
+        if mag is None or mag < MIN_MAG:  # an unknown magnitude can't be shown to meet the threshold
+            return False
+    if MAX_AGE_HOURS and now_ms - (props.get("time") or now_ms) > MAX_AGE_HOURS * 3600 * 1000:
+        return False
+    return True
 
-def _ai_summarize(plain: dict) -> str:
-    """Optional AI summary. Works with OpenRouter first, then HF as fallback."""
-    text = json.dumps(plain, ensure_ascii=False)
+def _fetch_usgs() -> list:
+    """Download the USGS GeoJSON feed and return the first MAX_ITEMS features that pass the filters."""
+    headers = {"User-Agent": "Mozilla/5.0"}
+    now_ms = time.time_ns() // 1_000_000
+    if ijson is None:
+        data = _request_json("GET", USGS_URL, headers, read_timeout=30, retries=_USGS_RETRY)
+        features = data.get("features", []) or []
+        return list(itertools.islice((f for f in features if _wanted(f, now_ms)), MAX_ITEMS))
+
+    # Parse features one at a time and stop reading once we have enough
+    resp = _send("GET", USGS_URL, headers, read_timeout=30, retries=_USGS_RETRY, stream=True)
+    try:
+        features = ijson.items(resp, "features.item", use_float=True)
+        return list(itertools.islice((f for f in features if _wanted(f, now_ms)), MAX_ITEMS))
+    finally:
+        resp.close()  # body may be only partly read, so don't hand the connection back
+
+def _prompt_line(plain: dict) -> str:
+    """Terse one-line description of a quake for the LLM prompt (far fewer tokens than the JSON)."""
+    mag = f"M{plain['magnitude']}" if plain["magnitude"] is not None else "Unknown magnitude"
+    place = plain["place"] or "unknown location"
+    depth = f"{plain['depth_km']}km" if plain["depth_km"] is not None else "unknown"
+    tsunami = "tsunami alert" if plain["tsunami"] else "no tsunami alert"
+    return f"{mag} near {place}, {plain['time_utc']}, depth {depth}, {tsunami}"
+
+def _ai_summarize(plain: dict, text: str = None) -> str:
+    """Optional AI summary. Works with OpenRouter first, then HF as fallback.
+
+    `text` is the already-encoded JSON of `plain`, used as the HF input.
+    """
 
     # 1) OpenRouter (chat completions)
     if OPENROUTER_API_KEY:
@@ -45,78 +175,210 @@ def _ai_summarize(plain: dict) -> str:
                 "model": MODEL,
                 "messages": [
                     {"role": "user",
-                     "content": "Summarize this earthquake for the public in 2 short sentences. "
-                                "Include magnitude, nearest place, UTC time, depth (km), and if tsunami alert exists. "
-                                + text}
+                     "content": _prompt_line(plain) + ". Summarize for the public in 2 short sentences."}
                 ]
             }
-            req = urllib.request.Request(
-                "https://openrouter.ai/api/v1/chat/completions",
-                data=json.dumps(body).encode("utf-8"),
-                headers={
-                    "Content-Type": "application/json",
-                    "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-                    "HTTP-Referer": "https://example.com",
-                    "X-Title": "Disaster Summarizer"
-                },
-                method="POST"
+            out = _request_json(
+                "POST",
+                OPENROUTER_URL,
+                OPENROUTER_HEADERS,
+                body,
+                read_timeout=40
             )
-            with urllib.request.urlopen(req, timeout=40) as resp:
-                out = json.loads(resp.read().decode("utf-8"))
-                return out["choices"][0]["message"]["content"].strip()
+            return out["choices"][0]["message"]["content"].strip()
         except Exception:
             pass  # fall through
 
     # 2) Hugging Face Inference (summarization)
     if HF_TOKEN:
         try:
-            body = {"inputs": text, "parameters": {"max_length": 120, "min_length": 30}}
-            req = urllib.request.Request(
+            # The summarization model just condenses arbitrary text, so it gets the full JSON
+            body = {"inputs": text or _dumps(plain), "parameters": {"max_length": 120, "min_length": 30}}
+            out = _request_json(
+                "POST",
                 "https://api-inference.huggingface.co/models/facebook/bart-large-cnn",
-                data=json.dumps(body).encode("utf-8"),
-                headers={
+                {
                     "Content-Type": "application/json",
                     "Authorization": f"Bearer {HF_TOKEN}"
                 },
-                method="POST"
+                body,
+                read_timeout=60
             )
-            with urllib.request.urlopen(req, timeout=60) as resp:
-                out = json.loads(resp.read().decode("utf-8"))
-                if isinstance(out, list) and out and "summary_text" in out[0]:
-                    return out[0]["summary_text"].strip()
-                if isinstance(out, dict) and "summary_text" in out:
-                    return out["summary_text"].strip()
-                return str(out)[:300]
+            if isinstance(out, list) and out and "summary_text" in out[0]:
+                return out[0]["summary_text"].strip()
+            if isinstance(out, dict) and "summary_text" in out:
+                return out["summary_text"].strip()
+            return str(out)[:300]
         except Exception:
             pass
 
     # 3) No key or both failed
     return "Summary unavailable."
 
-def _publish_feed(feed: list) -> None:
-    """Write alerts.json into the website bucket."""
-    body = json.dumps({"alerts": feed}, ensure_ascii=False).encode("utf-8")
-    s3.put_object(
+def _ai_summarize_bulk(plains: list):
+    """Summarize several quakes with one OpenRouter call. Returns None if that fails."""
+    try:
+        body = {
+            "model": MODEL,
+            "messages": [
+                {"role": "user",
+                 "content": f"Summarize each of these {len(plains)} earthquakes for the public in 2 short sentences. "
+                            "Reply with only a JSON object mapping each line number to its summary, "
+                            'like {"1": "...", "2": "..."}.\n'
+                            + "\n".join(f"{n}. {_prompt_line(p)}" for n, p in enumerate(plains, 1))}
+            ]
+        }
+        out = _request_json(
+            "POST",
+            OPENROUTER_URL,
+            OPENROUTER_HEADERS,
+            body,
+            read_timeout=60
+        )
+        content = out["choices"][0]["message"]["content"].strip()
+        # Models like to wrap JSON in a markdown code fence
+        content = content.removeprefix("```json").removeprefix("```").removesuffix("```")
+        summaries = _loads(content)
+        # Summaries are cached for good, so only accept an answer for exactly lines 1..N;
+        # anything reordered, merged or missing goes to the per-quake path instead
+        numbers = [str(n) for n in range(1, len(plains) + 1)]
+        if (isinstance(summaries, dict) and sorted(summaries) == sorted(numbers)
+                and all(isinstance(summaries[n], str) and summaries[n].strip() for n in numbers)):
+            return [summaries[n].strip() for n in numbers]
+    except Exception:
+        pass
+    return None
+
+def _summarize_all(plains: list, texts: list) -> list:
+    """Summaries for all quakes: batched OpenRouter prompts, per-quake calls for anything left.
+
+    `texts` holds the already-encoded JSON of each quake, for the HF fallback.
+    """
+    summaries = [None] * len(plains)
+
+    if OPENROUTER_API_KEY:
+        starts = range(0, len(plains), SUMMARY_BATCH)
+        batches = [plains[i:i + SUMMARY_BATCH] for i in starts]
+        for i, got in zip(starts, _EXECUTOR.map(_ai_summarize_bulk, batches)):
+            if got:
+                summaries[i:i + len(got)] = got
+
+    # Per-quake path (HF fallback, or a batch the model answered badly)
+    misses = [i for i, summary in enumerate(summaries) if summary is None]
+    retry = _EXECUTOR.map(_ai_summarize, [plains[i] for i in misses], [texts[i] for i in misses])
+    for i, summary in zip(misses, retry):
+        summaries[i] = summary
+    return summaries
+
+def _publish_feed(feed: list, maybe_unchanged: bool = True) -> None:
+    """Write alerts.json (gzip-encoded) into the website bucket.
+
+    Pass `maybe_unchanged=False` when the feed holds new items, to skip the HEAD check.
+    """
+    body = _dumpb({"alerts": feed})
+    content_hash = hashlib.sha256(body).hexdigest()
+
+    # Skip the upload when the published feed is already identical
+    if maybe_unchanged:
+        try:
+            head = _s3().head_object(Bucket=WEBSITE_BUCKET, Key="alerts.json")
+            if head.get("Metadata", {}).get("content-hash") == content_hash:
+                return
+        except Exception:
+            pass  # not there yet (or HEAD failed): just upload
+
+    _s3().put_object(
         Bucket=WEBSITE_BUCKET,
         Key="alerts.json",
-        Body=body,
+        Body=gzip.compress(body, compresslevel=6),
+        ContentEncoding="gzip",
         ContentType="application/json",
-        CacheControl="no-cache"
+        CacheControl="no-cache",
+        Metadata={"content-hash": content_hash}
     )
 
+_denied_logged = set()
+
+def _log_if_denied(op: str, err: Exception) -> None:
+    """Print (once per container) when IAM denies an operation, so a silent fallback shows in CloudWatch."""
+    code = (getattr(err, "response", None) or {}).get("Error", {}).get("Code", "")
+    if code.startswith("AccessDenied") and op not in _denied_logged:
+        _denied_logged.add(op)
+        print(f"dynamodb:{op} denied ({code}); grant it to the Lambda role. Falling back.")
+
+def _write_ddb_chunk(chunk: list) -> None:
+    """Best-effort write of up to 25 DynamoDB items with one BatchWriteItem call."""
+    try:
+        pending = {DDB_TABLE: [{"PutRequest": {"Item": it}} for it in chunk]}
+        for attempt in range(5):
+            resp = _ddb().batch_write_item(RequestItems=pending)
+            pending = resp.get("UnprocessedItems") or {}
+            if not pending:
+                break
+            # Throttled: back off (jittered, exponential) and resend only what's left
+            time.sleep(random.uniform(0, 0.05 * 2 ** attempt))
+        else:
+            raise RuntimeError("unprocessed items left after retries")
+    except Exception as e:
+        _log_if_denied("BatchWriteItem", e)
+        # Fall back to single puts for this chunk only
+        for it in chunk:
+            try:
+                _ddb().put_item(TableName=DDB_TABLE, Item=it)
+            except Exception:
+                pass
+
+def _batch_write_ddb(items: list) -> list:
+    """Start writing DynamoDB items on the worker pool, 25 per chunk. Returns the futures."""
+    # BatchWriteItem rejects duplicate keys in one request; last write wins like put_item
+    items = list({it["alert_id"]["S"]: it for it in items}.values())
+    return [_EXECUTOR.submit(_write_ddb_chunk, items[i:i + 25]) for i in range(0, len(items), 25)]
+
+def _cached_alerts(uids: list) -> dict:
+    """Best-effort lookup of already-summarized alerts: {alert_id: (summary, created_at)}."""
+    found = {}
+    keys = [{"alert_id": {"S": uid}} for uid in dict.fromkeys(uids)]  # no duplicate keys allowed
+    for i in range(0, len(keys), 100):
+        pending = {DDB_TABLE: {
+            "Keys": keys[i:i + 100],
+            "ProjectionExpression": "#id, #s, #c",
+            "ExpressionAttributeNames": {"#id": "alert_id", "#s": "summary", "#c": "created_at"}
+        }}
+        try:
+            for attempt in range(5):
+                resp = _ddb().batch_get_item(RequestItems=pending)
+                for item in resp.get("Responses", {}).get(DDB_TABLE, []):
+                    summary = item.get("summary", {}).get("S")
+                    # Failed summaries are retried rather than cached
+                    if summary and summary != "Summary unavailable.":
+                        created_at = item.get("created_at", {}).get("S")
+                        found[item["alert_id"]["S"]] = (summary, created_at)
+                pending = resp.get("UnprocessedKeys") or {}
+                if not pending:
+                    break
+                time.sleep(random.uniform(0, 0.05 * 2 ** attempt))
+        except Exception as e:
+            _log_if_denied("BatchGetItem", e)  # anything not found just gets summarized again
+    return found
+
 def handler(event, context):
+    # Build the AWS clients in the background while the feed downloads (no-op when warm)
+    for name in ("s3", "dynamodb"):
+        _EXECUTOR.submit(_client, name)
+
     # Fetch data
     try:
-        data = _fetch_usgs()
+        features = _fetch_usgs()
     except Exception as e:
         # Publish empty feed so UI still loads
         _publish_feed([])
         return {"error": f"USGS fetch failed: {e}"}
 
-    features = (data.get("features", []) or [])[:MAX_ITEMS]
     now_iso = datetime.now(timezone.utc).isoformat()
     feed_for_web = []
 
+    # Pass 1: extract the fields we need from each feature
+    plains = []
     for f in features:
         props = f.get("properties", {}) or {}
         geom = f.get("geometry", {}) or {}
@@ -125,57 +387,66 @@ def handler(event, context):
         mag = props.get("mag")
         place = props.get("place")
         tms = props.get("time")  # milliseconds
-        time_utc = (
-            datetime.fromtimestamp(tms / 1000, tz=timezone.utc).isoformat()
-            if tms else now_iso
-        )
+        time_utc = _fmt_iso(tms) if tms else now_iso
         depth_km = coords[2] if len(coords) >= 3 else None
         url = props.get("url") or ""
         tsunami = bool(props.get("tsunami", 0))
 
-        plain = {
+        plains.append({
             "magnitude": mag,
             "place": place,
             "time_utc": time_utc,
             "depth_km": depth_km,
             "tsunami": tsunami,
             "source": url
-        }
+        })
 
-        uid = _id(f"{time_utc}-{place}-{mag}")
-        summary = _ai_summarize(plain)
+    uids = [_id(f"{p['time_utc']}-{p['place']}-{p['magnitude']}") for p in plains]
 
-        # Best-effort: write to DynamoDB (non-blocking if it fails)
-        try:
-            dynamodb.put_item(
-                TableName=DDB_TABLE,
-                Item={
-                    "alert_id": {"S": uid},
-                    "created_at": {"S": now_iso},
-                    "type": {"S": "earthquake"},
-                    "raw": {"S": json.dumps(plain, ensure_ascii=False)},
-                    "summary": {"S": summary}
-                }
-            )
-        except Exception:
-            pass
+    # Pass 2: summarize only quakes not already summarized on an earlier run.
+    # Calls run concurrently; each keeps its own timeout and never raises.
+    # Without an AI backend every stored summary is "Summary unavailable.", so a lookup can't hit
+    cached = _cached_alerts(uids) if OPENROUTER_API_KEY or HF_TOKEN else {}
+    todo = [i for i, uid in enumerate(uids) if uid not in cached]
+    # Encode each new record once; the same string feeds the HF input and the DynamoDB copy
+    texts = {i: _dumps(plains[i]) for i in todo}
+    fresh = dict(zip(todo, _summarize_all([plains[i] for i in todo], [texts[i] for i in todo])))
+
+    ddb_items = []
+    for i, (uid, plain) in enumerate(zip(uids, plains)):
+        if i in fresh:
+            summary, created_at = fresh[i], now_iso
+            ddb_items.append({
+                "alert_id": {"S": uid},
+                "created_at": {"S": created_at},
+                "type": {"S": "earthquake"},
+                "raw": {"S": texts[i]},
+                "summary": {"S": summary}
+            })
+        else:
+            summary, created_at = cached[uid]
+            created_at = created_at or now_iso
 
         feed_for_web.append({
             "id": uid,
-            "created_at": now_iso,
+            "created_at": created_at,
             "type": "earthquake",
             "data": plain,
             "summary": summary
         })
 
-    # Keep the most recent N for the site
-    feed_for_web = sorted(feed_for_web, key=lambda x: x["created_at"], reverse=True)[:SUMMARIES_TO_KEEP]
+    # Keep the N most recent quakes (by event time) for the site.
+    # time_utc strings are all "+00:00" ISO, so they order correctly as text.
+    feed_for_web = heapq.nlargest(SUMMARIES_TO_KEEP, feed_for_web, key=lambda x: x["data"]["time_utc"])
 
-    # Publish to S3
-    try:
-        _publish_feed(feed_for_web)
-    except Exception:
-        # Don't crash the invocation if S3 write fails
-        pass
+    # Write the DynamoDB chunks and publish to S3 side by side; all best-effort
+    # New items carry this run's created_at, so the feed can only be unchanged when there are none
+    writes = _batch_write_ddb(ddb_items) + [_EXECUTOR.submit(_publish_feed, feed_for_web, not ddb_items)]
+    for fut in writes:
+        try:
+            fut.result()
+        except Exception:
+            # Don't crash the invocation if a write fails
+            pass
 
     return {"count": len(feed_for_web)}